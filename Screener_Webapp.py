@@ -1,6 +1,10 @@
-from flask import Flask, render_template, jsonify, request, current_app
+from flask import Flask, render_template, jsonify, request, current_app, has_request_context
 import download_universe
 import Stock_Screener
+import screen_expressions
+import saved_screens
+import failure_registry
+import sector_stats
 import threading
 import webbrowser
 import time
@@ -11,8 +15,6 @@ from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.chrome.service import Service
 import numpy as np
 import os
-import re
-from scipy.stats import iqr
 
 app = Flask(__name__)
 
@@ -42,8 +44,9 @@ def fetch_and_save_metrics():
     tickers_df = pd.read_csv("Stock_Universe.csv")  # Tickers
     output_csv = 'financial_metrics.csv'
 
-    # Set a default value for max_workers
-    max_workers = 10
+    # Download threads only wait on the network, so they can outnumber the cores;
+    # metric computation runs in a process pool sized to the available cores
+    max_workers = 32
 
     # Call the function to fetch financial data and save it
     Stock_Screener.fetch_financial_data_and_save(tickers_df, output_csv, max_workers)
@@ -68,6 +71,11 @@ def run_daily_tasks():
             print("All tasks completed for the day.")
     except Exception as e:
         print(f"Error during calculating industry averages: {str(e)}")
+    try:
+        saved_screens.run_saved_screens('financial_metrics.csv')  # Step 4: Re-evaluate saved screens
+        print("Saved screens have been evaluated.")
+    except Exception as e:
+        print(f"Error during saved screen evaluation: {str(e)}")
 
 # Initialize the APScheduler
 scheduler = BackgroundScheduler()
@@ -75,36 +83,39 @@ scheduler = BackgroundScheduler()
 # Schedule the tasks to run daily at 4:30 PM (you can adjust the time)
 scheduler.add_job(run_daily_tasks, CronTrigger(hour=20, minute=30))  # Runs at 4:30 PM every day
 
-# Start the scheduler
-scheduler.start()
+# Start the scheduler (not when this module is re-imported as __mp_main__ by a spawned metrics worker)
+if __name__ != '__mp_main__':
+    scheduler.start()
 
 # Flask route to check if the tasks are running
 @app.route('/check-status', methods=['GET'])
 def check_status():
     return jsonify({'status': 'Tasks are running'})
 
+def merge_highlights(metrics_df):
+    # Attach the int8 highlight codes; tickers without highlights count as "within"
+    highlighted_df = Stock_Screener.load_highlights('highlighted_sector_averages.csv')
+    merged_df = pd.merge(metrics_df, highlighted_df, on='Ticker', how='left')
+    highlight_columns = [col for col in highlighted_df.columns if col.endswith('_highlight')]
+    merged_df[highlight_columns] = merged_df[highlight_columns].fillna(Stock_Screener.HIGHLIGHT_CODES['within']).astype(np.int8)
+    return merged_df
+
+def encode_response(merged_df):
+    # "?format=columnar" returns column arrays plus dictionaries, otherwise one record per ticker
+    if request.args.get('format') == 'columnar':
+        return jsonify(Stock_Screener.to_columnar(merged_df))
+    return jsonify(Stock_Screener.to_display_records(merged_df))
+
 @app.route('/get_initial_data', methods=['GET'])
 def get_initial_data():
     try:
 
-        # Load the financial data and highlighted data
-        financial_df = pd.read_csv('financial_metrics.csv')
-        highlighted_df = pd.read_csv('highlighted_sector_averages.csv')
-
-        # Merge on 'Ticker' (or another appropriate column)
-        merged_df = pd.merge(financial_df, highlighted_df, on='Ticker', how='left')
-
-        # Replace 'N/A', inf, and -inf with np.nan
-        merged_df.replace([np.inf, -np.inf, 'N/A'], np.nan, inplace=True)
-
-        # Explicitly call infer_objects to avoid future warnings
-        merged_df = merged_df.infer_objects()
-
-        # Replace all NaN values in the processed DataFrame with "N/A"
-        merged_df = merged_df.fillna("N/A")
+        # Load the financial data and merge in the highlighted data
+        financial_df = Stock_Screener.load_financial_metrics('financial_metrics.csv')
+        merged_df = merge_highlights(financial_df)
 
         # Return JSON response
-        return jsonify(merged_df.to_dict(orient="records"))
+        return encode_response(merged_df)
 
     except Exception as e:
         print(f"Error in get_initial_data: {str(e)}")
@@ -133,30 +144,28 @@ def get_sectors():
     return jsonify(sectors)
 
 
-# Function to clean up any problematic characters and ensure formatting consistency
-def clean_text(text):
-    if isinstance(text, str):
-        # Standardize and fix encoding issues
-        text = text.replace('â€”', ' - ')
-        text = text.replace('—', ' - ')
-
-        # Special handling for REITs (ensure "REIT-" stays intact)
-        text = text.replace("REIT-", "REIT - ")
-
-        # Add a space before any uppercase letter following a lowercase (e.g., REITDiversified -> REIT - Diversified)
-        text = re.sub(r'([a-z])([A-Z])', r'\1 - \2', text)
-
-        return text.strip()  # Only strip strings
-    return text  # Return the original value if it's not a string (e.g., float, NaN, etc.)
+# Highlight settings used by the daily job, set through the HIGHLIGHT_MODE and HIGHLIGHT_LEVEL environment variables.
+# ?mode= and ?level= on /save_highlighted_data are one-off overrides: the next daily run goes back to these settings.
+HIGHLIGHT_MODE = os.environ.get('HIGHLIGHT_MODE', 'ratio')     # 'ratio' (±35% of the trimmed mean) or 'percentile' (rank within the group)
+HIGHLIGHT_LEVEL = os.environ.get('HIGHLIGHT_LEVEL', 'Sector')  # 'Sector', or 'Industry' (falls back to the sector for small industries)
+if HIGHLIGHT_MODE not in sector_stats.HIGHLIGHT_MODES or HIGHLIGHT_LEVEL not in sector_stats.STATS_LEVELS:
+    raise ValueError(f"Unknown HIGHLIGHT_MODE {HIGHLIGHT_MODE} or HIGHLIGHT_LEVEL {HIGHLIGHT_LEVEL}.")
 
 @app.route('/save_highlighted_data', methods=['GET', 'POST'])
 def save_highlighted_data():
+    mode, level = HIGHLIGHT_MODE, HIGHLIGHT_LEVEL
+    if has_request_context():
+        mode = request.args.get('mode', mode)
+        level = request.args.get('level', level)
+    if mode not in sector_stats.HIGHLIGHT_MODES or level not in sector_stats.STATS_LEVELS:
+        return jsonify({'status': 'error', 'message': f'Unknown highlight mode {mode} or level {level}.'}), 400
+
     try:
         # Load the data from 'financial_metrics.csv' for processing
-        df = pd.read_csv('financial_metrics.csv')
+        df = Stock_Screener.load_financial_metrics('financial_metrics.csv')
 
-        # Calculate highlights based on sector averages and save to CSV
-        highlighted_df = calculate_and_highlight_sector_averages(df)
+        # Calculate highlights based on sector/industry statistics and save to CSV
+        highlighted_df = calculate_and_highlight_sector_averages(df, mode, level)
         highlighted_df.to_csv('highlighted_sector_averages.csv', index=False)
 
         print('Highlighted data saved successfully.')
@@ -167,101 +176,137 @@ def save_highlighted_data():
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
-def calculate_and_highlight_sector_averages(df):
-    # Clean the Industry column
-    df['Sector'] = df['Sector'].apply(clean_text)
+def calculate_and_highlight_sector_averages(df, mode='ratio', level='Sector'):
+    # Sector/Industry are cleaned categoricals and metrics are float32 (see Stock_Screener.compact_metrics)
+    df = Stock_Screener.compact_metrics(df)
     df = df.dropna(subset=['Sector']).copy()
-    df.replace(['N/A', np.inf, -np.inf], np.nan, inplace=True)
     columns_to_exclude = ['Ticker', 'Market Cap', 'Recent 52-Week High', 'Sector', 'Industry']
     numeric_columns = [col for col in df.columns if col not in columns_to_exclude]
 
-    # Calculate sector averages and apply IQR filtering
-    sector_avg_dict = {}
-    for sector, group in df.groupby('Sector'):
-        sector_avg_dict[sector] = {}
-        for col in numeric_columns:
-            valid_data = group[col].dropna()
-            if len(valid_data) > 0:
-                q1 = valid_data.quantile(0.25)
-                q3 = valid_data.quantile(0.75)
-                lower_bound = q1 - 1.5 * iqr(valid_data)
-                upper_bound = q3 + 1.5 * iqr(valid_data)
-                filtered_data = valid_data[(valid_data >= lower_bound) & (valid_data <= upper_bound)]
-                sector_avg_dict[sector][col] = filtered_data.mean() if len(filtered_data) > 0 else np.nan
-            else:
-                sector_avg_dict[sector][col] = np.nan
-
-    # Convert to DataFrame for easier merging and highlighting
-    sector_avg_df = pd.DataFrame.from_dict(sector_avg_dict, orient='index')
-    sector_avg_df.to_csv('sector_averages.csv', index=True)  # Save sector averages
+    # Trimmed means, medians and quantiles per sector and per industry, saved as the /sector_stats lookup table
+    stats_df, row_stats = sector_stats.compute_group_stats(df, numeric_columns)
+    sector_stats.save_stats(stats_df)
 
-    # Convert to DataFrame for easier merging and highlighting
-    sector_avg_df = pd.DataFrame.from_dict(sector_avg_dict, orient='index')
+    # Keep the sector averages (IQR-trimmed means) file as before
+    sector_rows = stats_df[stats_df['Level'] == 'Sector'].astype({'Group': object, 'Metric': object})
+    sector_avg_df = sector_rows.pivot(index='Group', columns='Metric', values='trimmed_mean').reindex(columns=numeric_columns)
+    sector_avg_df.index.name = None
     sector_avg_df.to_csv('sector_averages.csv', index=True)  # Save sector averages
 
-    # Copy the original DataFrame to preserve data integrity
-    highlighted_df = df.copy()
+    # Start from the tickers and add one int8 highlight code per metric
+    final_df = df[['Ticker']].copy()
 
-    # Add highlighting based on sector average comparisons
     for col in numeric_columns:
-        def highlight_comparison(row):
-            sector_avg = sector_avg_df.at[row['Sector'], col] if row['Sector'] in sector_avg_df.index else None
-            if pd.isnull(sector_avg) or pd.isnull(row[col]):
-                return "within"
-
-            # Determine the comparison thresholds based on whether the sector average is positive or negative
-            if sector_avg > 0:
-                above_threshold = sector_avg * 1.35
-                below_threshold = sector_avg * 0.65
-            else:
-                above_threshold = sector_avg * 0.65  # A smaller negative number (closer to zero) is "above" the average
-                below_threshold = sector_avg * 1.35  # A larger negative number (further from zero) is "below" the average
-
-            # Apply the highlighting logic
-            if row[col] > above_threshold:
-                return "above"
-            elif row[col] < below_threshold:
-                return "below"
-            else:
-                return "within"
-        highlighted_df[f"{col}_highlight"] = highlighted_df.apply(highlight_comparison, axis=1)
+        benchmark = sector_stats.row_benchmark(row_stats, col, level)
+        values = df[col].to_numpy(dtype=np.float64)
+
+        if mode == 'percentile':
+            # Percentile rank within the group, unaffected by averages near zero
+            above = benchmark['percentile'] >= sector_stats.PERCENTILE_BANDS[1]
+            below = benchmark['percentile'] <= sector_stats.PERCENTILE_BANDS[0]
+        else:
+            # Determine the comparison thresholds based on whether the group average is positive or negative
+            # (a smaller negative number, closer to zero, is "above" the average)
+            group_avg = benchmark['trimmed_mean']
+            above = values > np.where(group_avg > 0, group_avg * 1.35, group_avg * 0.65)
+            below = values < np.where(group_avg > 0, group_avg * 0.65, group_avg * 1.35)
+
+        # Missing values or averages compare as False and stay "within"
+        final_df[f"{col}_highlight"] = np.select(
+            [above, below],
+            [Stock_Screener.HIGHLIGHT_CODES['above'], Stock_Screener.HIGHLIGHT_CODES['below']],
+            default=Stock_Screener.HIGHLIGHT_CODES['within'],
+        ).astype(np.int8)
 
     # Save only 'Ticker' and highlighted columns to CSV
-    highlight_columns = [col for col in highlighted_df.columns if '_highlight' in col]
-    final_df = highlighted_df[['Ticker'] + highlight_columns]
     final_df.to_csv('highlighted_sector_averages.csv', index=False)
 
     return final_df
 
+@app.route('/sector_stats', methods=['GET'])
+def get_sector_stats():
+    # Lookup table of per-sector and per-industry statistics, optionally narrowed by ?level=, ?group= and ?metric=
+    try:
+        stats_df = sector_stats.load_stats()
+    except FileNotFoundError:
+        return jsonify({'status': 'error', 'message': 'Sector statistics have not been computed yet.'}), 404
+
+    for arg, col in [('level', 'Level'), ('group', 'Group'), ('metric', 'Metric')]:
+        if request.args.get(arg):
+            stats_df = stats_df[stats_df[col] == request.args[arg]]
+
+    return encode_response(stats_df)
+
 @app.route('/filter_data', methods=['POST'])
 def filter_data():
     # Get the incoming JSON data from the request (filters sent from the frontend)
     received_filters = request.json
 
-    # Convert lists to tuples in the filters (if necessary)
-    filters = {}
-    for key, value in received_filters.items():
-        if isinstance(value, list):
-            filters[key] = tuple(value)  # Convert list to tuple
-        else:
-            filters[key] = value  # Keep as is for non-list items like booleans or strings
-
     # Apply the filters using the filter_saved_data function
-    filtered_df = Stock_Screener.filter_saved_data("financial_metrics.csv", filters)
-
-    # Load highlighted data
-    highlighted_df = pd.read_csv('highlighted_sector_averages.csv')
-
-    # Merge on 'Ticker' (or another appropriate column)
-    merged_df = pd.merge(filtered_df, highlighted_df, on='Ticker', how='left')
-
-    # Replace all NaN values in the processed DataFrame with "N/A"
-    merged_df = merged_df.fillna("N/A")
-
-    # Convert the filtered DataFrame to JSON and return it
-    data = merged_df.to_dict(orient='records')
-
-    return jsonify(data)
+    try:
+        screen = saved_screens.parse_screen(received_filters)
+        filtered_df = Stock_Screener.filter_saved_data("financial_metrics.csv", screen['filters'], fill_na=False,
+                                                       derived_columns=screen['derived_columns'], expressions=screen['expressions'])
+    except screen_expressions.ExpressionError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    # Merge in the highlighted data and return it in the requested format
+    merged_df = merge_highlights(filtered_df)
+
+    return encode_response(merged_df)
+
+@app.route('/ticker_failures', methods=['GET'])
+def ticker_failures():
+    # Summary by failure class plus quarantined tickers; ?details=1 includes every registry entry
+    registry = failure_registry.load_registry()
+    summary = failure_registry.summarize(registry)
+    if request.args.get('details', '').lower() in ('1', 'true', 'yes'):
+        summary['entries'] = registry
+    return jsonify(summary)
+
+@app.route('/ticker_failures/<ticker>', methods=['DELETE'])
+def release_ticker(ticker):
+    # Forget a ticker's failures so it is fetched again on the next run (a fetch in progress
+    # merges its results into the registry on disk, so the release is kept)
+    registry = failure_registry.load_registry()
+    if ticker not in registry:
+        return jsonify({'status': 'error', 'message': f'{ticker} has no recorded failures.'}), 404
+    failure_registry.record_success(registry, ticker)
+    failure_registry.save_registry(registry)
+    return jsonify({'status': 'success', 'message': f'{ticker} released.'}), 200
+
+@app.route('/screens', methods=['GET'])
+def list_screens():
+    return jsonify(saved_screens.load_screens())
+
+@app.route('/screens/<name>', methods=['PUT', 'POST'])
+def save_screen(name):
+    # The body uses the same format as /filter_data
+    try:
+        saved_screens.save_screen(name, request.json, df=Stock_Screener.load_financial_metrics('financial_metrics.csv'))
+    except screen_expressions.ExpressionError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({'status': 'success', 'message': f'Screen {name} saved.'}), 200
+
+@app.route('/screens/<name>', methods=['DELETE'])
+def delete_screen(name):
+    if not saved_screens.delete_screen(name):
+        return jsonify({'status': 'error', 'message': f'Screen {name} not found.'}), 404
+    return jsonify({'status': 'success', 'message': f'Screen {name} deleted.'}), 200
+
+@app.route('/screens/results', methods=['GET'])
+def screen_results():
+    # Members and entered/exited tickers from the last run, without re-running any screen
+    return jsonify(saved_screens.decode_screen_results(saved_screens.load_screen_results()))
+
+@app.route('/screens/run', methods=['POST'])
+def run_screens():
+    try:
+        results = saved_screens.run_saved_screens('financial_metrics.csv')
+        return jsonify(saved_screens.decode_screen_results(results))
+    except Exception as e:
+        print(f"Error in run_screens: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
 def open_browser():
     """Wait for the server to start, then open the default web browser."""
@@ -1,9 +1,16 @@
 import yfinance as yf
 import pandas as pd
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
+import queue
+import multiprocessing
+import threading
+import os
 import re
+import screen_expressions
+import failure_registry
 
 def calculate_fcf_ttm(stock):
     # Free Cash Flow TTM calculation
@@ -38,25 +45,37 @@ def calculate_free_cash_flow_yield(stock, info):
     except Exception as e:
         return 'N/A'
 
+# Vectorized 4-year CAGR: works on scalars or on arrays of start/end values for many tickers at once
+def calculate_cagr(start, end, years=4):
+    start = np.asarray(start, dtype=np.float64)
+    end = np.asarray(end, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth_percent = (((end / start) ** (1 / years)) - 1) * 100
+
+    # Only defined when both values share a sign; for two negatives the direction is flipped
+    both_positive = (start > 0) & (end > 0)
+    both_negative = (start < 0) & (end < 0)
+    return np.where(both_positive, growth_percent, np.where(both_negative, growth_percent * -1, np.nan))
+
+def get_cagr_endpoints(statement, row):
+    # Returns (start, end) of the last 4 non-missing periods, or NaNs if there are fewer than 4
+    try:
+        values = statement.loc[row].dropna().tail(4)
+        if len(values) == 4:
+            return float(values.iloc[-1]), float(values.iloc[0])
+    except Exception:
+        pass
+    return np.nan, np.nan
+
+def nan_to_na(value):
+    return 'N/A' if pd.isnull(value) else float(value)
+
 def calculate_eps_growth(income_stmt):
     try:
-        # Fetch the last 4 annual EPS values
-        eps_data = income_stmt.loc['Basic EPS'].dropna().tail(4)
-
-
-        # Calculate 4-year EPS growth rate if start and end values are valid
-        if len(eps_data) == 4 and (eps_data.iloc[0] > 0) and (eps_data.iloc[-1] > 0):
-            eps_start = eps_data.iloc[-1]
-            eps_end = eps_data.iloc[0]
-            eps_growth_percent = (((eps_end / eps_start) ** (1 / 4)) - 1) * 100
-            return eps_growth_percent
-        if len(eps_data) == 4 and (eps_data.iloc[0] < 0) and (eps_data.iloc[-1] < 0):
-            eps_start = eps_data.iloc[-1]
-            eps_end = eps_data.iloc[0]
-            eps_growth_percent = ((((eps_end / eps_start) ** (1 / 4)) - 1) * 100) * -1
-            return eps_growth_percent
-        else:
-            return 'N/A'
+        # Calculate 4-year EPS growth rate from the last 4 annual EPS values
+        eps_start, eps_end = get_cagr_endpoints(income_stmt, 'Basic EPS')
+        return nan_to_na(calculate_cagr(eps_start, eps_end))
     except Exception as e:
         return 'N/A'
 
@@ -147,29 +166,9 @@ def calculate_roaa_ttm(stock):
 
 def calculate_revenue_growth(stock):
     try:
-        # Fetch financials data (annual data)
-        financials = stock.financials
-
-        # Ensure that financials data exists and Total Revenue is available
-        if 'Total Revenue' in financials.index:
-            # Fetch the last 4 annual revenue values
-            revenue_data = financials.loc['Total Revenue'].dropna().tail(4)  # Exclude NaNs and get last 4 periods
-
-            # Check if the signs of the first and last revenue values are the same
-            if len(revenue_data) == 4 and (revenue_data.iloc[0] > 0) and (revenue_data.iloc[-1] > 0):
-                revenue_start = revenue_data.iloc[-1]  # Revenue from the earliest date
-                revenue_end = revenue_data.iloc[0]  # Revenue from the latest date
-                revenue_growth_percent = (((revenue_end / revenue_start) ** (1 / 4)) - 1) * 100  # CAGR formula
-                return revenue_growth_percent
-            if len(revenue_data) == 4 and (revenue_data.iloc[0] < 0) and (revenue_data.iloc[-1] < 0):
-                revenue_start = revenue_data.iloc[-1]  # Revenue from the earliest date
-                revenue_end = revenue_data.iloc[0]  # Revenue from the latest date
-                revenue_growth_percent = ((((revenue_end / revenue_start) ** (1 / 4)) - 1) * 100 ) * -1 # CAGR formula
-                return revenue_growth_percent
-            else:
-                return 'N/A'  # Return 'N/A' if signs are different
-        else:
-            return 'N/A'  # If 'Total Revenue' is not in the financial data
+        # Calculate 4-year revenue CAGR from the last 4 annual Total Revenue values (annual data)
+        revenue_start, revenue_end = get_cagr_endpoints(stock.financials, 'Total Revenue')
+        return nan_to_na(calculate_cagr(revenue_start, revenue_end))
     except Exception as e:
         print(f"Error in Revenue Growth calculation: {e}")
         return 'N/A'
@@ -206,11 +205,47 @@ def is_bank_or_insurance(info):
     # Check for banks or insurance companies in the Financial Services sector
     return sector == 'Financial Services' and ('Bank' in industry or 'Insurance' in industry)
 
+class RawStatements:
+    """
+    Everything downloaded for one ticker, so metric computation needs no network access.
+    Exposes the same attributes as yf.Ticker for the calculate_* helpers and pickles cleanly
+    for the process pool.
+    """
+
+    def __init__(self, ticker, info, financials, quarterly_financials, quarterly_balance_sheet, quarterly_cashflow, price_history):
+        self.ticker = ticker
+        self.info = info
+        self.financials = financials
+        self.quarterly_financials = quarterly_financials
+        self.quarterly_balance_sheet = quarterly_balance_sheet
+        self.quarterly_cashflow = quarterly_cashflow
+        self.price_history = price_history
+
+    def history(self, period="1y", interval="1d"):
+        return self.price_history
+
+# I/O stage: download the raw statements for a single stock ticker
+def fetch_raw_statements(ticker):
+    stock = yf.Ticker(ticker)
+    return RawStatements(
+        ticker=ticker,
+        info=stock.info,
+        financials=stock.financials,
+        quarterly_financials=stock.quarterly_financials,
+        quarterly_balance_sheet=stock.quarterly_balance_sheet,
+        quarterly_cashflow=stock.quarterly_cashflow,
+        price_history=stock.history(period="1y", interval="1d")[['High']],
+    )
+
 # Function to fetch financial data for a single stock ticker
 def fetch_financial_data(ticker):
-    stock = yf.Ticker(ticker)
+    stock = fetch_raw_statements(ticker)
+    return build_financial_data(stock, calculate_revenue_growth(stock), calculate_eps_growth(stock.financials))
+
+# CPU stage: compute the metrics row from downloaded statements
+def build_financial_data(stock, revenue_growth, eps_growth):
+    ticker = stock.ticker
     info = stock.info
-    income_stmt = stock.financials
 
     forward_eps_growth = safe_numeric(info.get('earningsGrowth', 'N/A')) * 100 if info.get('earningsGrowth') else 'N/A'
 
@@ -237,8 +272,8 @@ def fetch_financial_data(ticker):
         'Dividend Yield (%)': safe_numeric(info.get('dividendYield', 'N/A')) * 100 if info.get('dividendYield') else 'N/A',
         'Current Ratio': 'N/A' if is_financial_institution else safe_numeric(info.get('currentRatio', 'N/A')),
         'Debt/Equity': 'N/A' if is_financial_institution else safe_numeric(info.get('debtToEquity', 'N/A')) / 100 if safe_numeric(info.get('debtToEquity', 'N/A')) != 'N/A' else 'N/A',
-        'Revenue Growth 4Y (%)': calculate_revenue_growth(stock),
-        'EPS Growth 4Y (%)': calculate_eps_growth(income_stmt),
+        'Revenue Growth 4Y (%)': revenue_growth,
+        'EPS Growth 4Y (%)': eps_growth,
         'Forward EPS Growth (%)': forward_eps_growth,
         'EPS': safe_numeric(info.get('trailingEps', 'N/A')),
         'PEG Ratio': peg_ratio,
@@ -255,6 +290,26 @@ def fetch_financial_data(ticker):
         'Industry': info.get('industry', 'N/A'),
     }
 
+# CPU stage, run in a worker process: compute metrics for a batch of tickers,
+# with the CAGR math vectorized across the whole batch
+def compute_financial_data_batch(raw_batch):
+    revenue_endpoints = np.array([get_cagr_endpoints(raw.financials, 'Total Revenue') for raw in raw_batch], dtype=np.float64).reshape(-1, 2)
+    eps_endpoints = np.array([get_cagr_endpoints(raw.financials, 'Basic EPS') for raw in raw_batch], dtype=np.float64).reshape(-1, 2)
+    revenue_growth = calculate_cagr(revenue_endpoints[:, 0], revenue_endpoints[:, 1])
+    eps_growth = calculate_cagr(eps_endpoints[:, 0], eps_endpoints[:, 1])
+
+    # Returns (ticker, data, (failure class, message)) tuples so one bad ticker doesn't lose the batch
+    results = []
+    for raw, revenue, eps in zip(raw_batch, revenue_growth, eps_growth):
+        try:
+            data = build_financial_data(raw, nan_to_na(revenue), nan_to_na(eps))
+            # Clean up any problematic text/characters in the Industry field
+            data['Industry'] = clean_text(data['Industry'])
+            results.append((raw.ticker, data, None))
+        except Exception as e:
+            results.append((raw.ticker, None, (failure_registry.classify_failure(e), str(e))))
+    return results
+
 def clean_text(text):
     if isinstance(text, str):
         # Standardize and fix encoding issues
@@ -270,28 +325,206 @@ def clean_text(text):
         return text.strip()  # Only strip strings
     return text  # Return the original value if it's not a string (e.g., float, NaN, etc.)
 
-# Function to fetch financial data and save to CSV with multithreading and progress bar
-def fetch_financial_data_and_save(ticker_df, output_csv, max_workers=10):
-    ticker_list = ticker_df['Ticker'].tolist()
-    data_list = []
+# Highlight flags are stored as int8 codes instead of repeating "above"/"within"/"below" for every ticker
+HIGHLIGHT_CODES = {'below': -1, 'within': 0, 'above': 1}
+HIGHLIGHT_LABELS = {code: label for label, code in HIGHLIGHT_CODES.items()}
 
-    # Use ThreadPoolExecutor for multithreading
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit tasks to the executor
-        future_to_ticker = {executor.submit(fetch_financial_data, ticker): ticker for ticker in ticker_list}
+# Columns kept as categoricals, and metrics that need full float64 precision (everything else is float32)
+CATEGORICAL_COLUMNS = ['Sector', 'Industry']
+FLOAT64_COLUMNS = ['Market Cap']
+NON_METRIC_COLUMNS = ['Ticker', 'Recent 52-Week High'] + CATEGORICAL_COLUMNS
 
-        # Use tqdm to add a progress bar
-        for future in tqdm(as_completed(future_to_ticker), total=len(ticker_list), desc="Fetching data"):
-            ticker = future_to_ticker[future]
-            try:
-                data = future.result()
-                # Clean up any problematic text/characters in the Industry field
-                if 'Industry' in data:
-                    data['Industry'] = clean_text(data['Industry'])
+def compact_metrics(df):
+    """Convert a raw metrics DataFrame to compact dtypes (categoricals and float32 ratios)."""
+    df = df.replace(['N/A', np.inf, -np.inf], np.nan)
+
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].map(clean_text).astype('category')
+
+    for col in df.columns:
+        if col in NON_METRIC_COLUMNS:
+            continue
+        dtype = np.float64 if col in FLOAT64_COLUMNS else np.float32
+        df[col] = pd.to_numeric(df[col], errors='coerce').astype(dtype)
+
+    return df
+
+def load_financial_metrics(input_csv='financial_metrics.csv'):
+    """Load the metrics snapshot with compact dtypes."""
+    return compact_metrics(pd.read_csv(input_csv, encoding='utf-8'))
+
+def encode_highlights(df):
+    """Convert every *_highlight column to int8 codes (accepts legacy string labels)."""
+    df = df.copy()
+    for col in [col for col in df.columns if col.endswith('_highlight')]:
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].map(HIGHLIGHT_CODES)
+        df[col] = df[col].fillna(HIGHLIGHT_CODES['within']).astype(np.int8)
+    return df
+
+def load_highlights(input_csv='highlighted_sector_averages.csv'):
+    """Load the highlight snapshot with int8 highlight codes."""
+    return encode_highlights(pd.read_csv(input_csv, encoding='utf-8'))
+
+def _shortest_floats(series):
+    # float32 -> Python float via its shortest repr, so 1.1 is not sent as 1.100000023841858
+    values = series.to_numpy()
+    if values.dtype == np.float32:
+        values = values.astype(str).astype(np.float64)
+    return [None if np.isnan(value) else float(value) for value in values]
+
+def to_display_records(df):
+    """Expand a compact DataFrame into the row-per-ticker records used by the table ("N/A" for missing)."""
+    df = df.copy()
+    for col in df.columns:
+        if col.endswith('_highlight'):
+            df[col] = df[col].map(HIGHLIGHT_LABELS).astype(object)
+        elif isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+        elif pd.api.types.is_float_dtype(df[col]):
+            df[col] = pd.Series(_shortest_floats(df[col]), index=df.index, dtype=object)
+    df = df.astype(object).where(df.notna(), 'N/A')
+    return df.to_dict(orient='records')
+
+def to_columnar(df):
+    """
+    Encode a compact DataFrame as column arrays plus dictionaries.
+
+    Categorical columns are sent as integer codes (-1 for missing) into 'dictionaries',
+    highlight columns as their int8 codes, and missing numeric values as null.
+    """
+    payload = {
+        'columns': list(df.columns),
+        'length': len(df),
+        'data': {},
+        'dictionaries': {},
+        'highlight_labels': {str(code): label for code, label in HIGHLIGHT_LABELS.items()},
+    }
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            payload['dictionaries'][col] = series.cat.categories.tolist()
+            payload['data'][col] = series.cat.codes.tolist()
+        elif pd.api.types.is_float_dtype(series):
+            payload['data'][col] = _shortest_floats(series)
+        else:
+            payload['data'][col] = series.astype(object).where(series.notna(), None).tolist()
+    return payload
+
+# Function to fetch financial data and save to CSV with a two-stage pipeline and progress bar:
+# max_workers threads only download raw statements into a bounded queue, and a process pool
+# computes the metrics in batches of batch_size tickers (cpu_workers defaults to the core count).
+# Tickers quarantined in the failure registry are skipped until their re-probe date.
+def fetch_financial_data_and_save(ticker_df, output_csv, max_workers=10, cpu_workers=None, batch_size=50,
+                                  failures_path=failure_registry.FAILURES_JSON):
+    registry = failure_registry.load_registry(failures_path)
+    ticker_list = [ticker for ticker in ticker_df['Ticker'].tolist() if not failure_registry.is_quarantined(registry, ticker)]
+    print(f"Skipping {len(ticker_df) - len(ticker_list)} quarantined tickers")
+    cpu_workers = cpu_workers or os.cpu_count() or 1
+    data_list = []
 
-                data_list.append(data)
+    # Downloads block once the queue is full, so memory stays bounded if the CPU stage falls behind
+    raw_queue = queue.Queue(maxsize=batch_size * cpu_workers * 2)
+    stop = threading.Event()
+
+    def download(ticker):
+        if stop.is_set():
+            return
+        try:
+            item = (ticker, fetch_raw_statements(ticker), None)
+        except Exception as e:
+            item = (ticker, None, (failure_registry.classify_failure(e), str(e)))
+        # Give up on a full queue once the run is stopping, so shutdown never waits on a blocked put
+        while not stop.is_set():
+            try:
+                raw_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    # Outcome per ticker, applied to the registry on disk at the end of the run
+    outcomes = {}
+
+    def record_failure(ticker, error):
+        failure_class, message = error
+        print(f"Error fetching data for {ticker} ({failure_class}): {message}")
+        outcomes[ticker] = error
+
+    def record_batch_failure(batch_tickers, e):
+        # A crashed worker (e.g. BrokenProcessPool after an OOM kill) fails its batch, not the whole run
+        for ticker in batch_tickers:
+            record_failure(ticker, (failure_registry.ERROR, f"Metric computation failed: {e!r}"))
+
+    def collect(futures):
+        for future in futures:
+            batch_tickers = pending.pop(future)
+            try:
+                results = future.result()
             except Exception as e:
-                print(f"Error fetching data for {ticker}: {e}")
+                record_batch_failure(batch_tickers, e)
+                continue
+            for ticker, data, error in results:
+                if error is not None:
+                    record_failure(ticker, error)
+                else:
+                    outcomes[ticker] = None
+                    data_list.append(data)
+
+    def start_pool():
+        # Worker processes are spawned rather than forked: forking while the download threads run can deadlock the child
+        return ProcessPoolExecutor(max_workers=cpu_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(batch):
+        nonlocal cpu_executor
+        try:
+            pending[cpu_executor.submit(compute_financial_data_batch, batch)] = [raw.ticker for raw in batch]
+        except BrokenProcessPool:
+            # Only the batches in flight when a worker died are lost; later batches get a fresh pool
+            cpu_executor.shutdown(wait=False, cancel_futures=True)
+            cpu_executor = start_pool()
+            pending[cpu_executor.submit(compute_financial_data_batch, batch)] = [raw.ticker for raw in batch]
+
+    cpu_executor = start_pool()
+    io_executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    try:
+        for ticker in ticker_list:
+            io_executor.submit(download, ticker)
+
+        batch = []
+        # Use tqdm to add a progress bar over downloaded tickers
+        for _ in tqdm(range(len(ticker_list)), desc="Fetching data"):
+            ticker, raw, error = raw_queue.get()
+            if error is not None:
+                record_failure(ticker, error)
+            else:
+                batch.append(raw)
+
+            if len(batch) >= batch_size:
+                # Keep at most two batches per process in flight
+                if len(pending) >= cpu_workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                submit(batch)
+                batch = []
+
+        if batch:
+            submit(batch)
+        collect(wait(pending).done)
+    finally:
+        # Stop the downloads, unblock any thread waiting on the full queue, and drop queued work
+        stop.set()
+        io_executor.shutdown(wait=False, cancel_futures=True)
+        while True:
+            try:
+                raw_queue.get_nowait()
+            except queue.Empty:
+                break
+        io_executor.shutdown(wait=True)
+        cpu_executor.shutdown(wait=True, cancel_futures=True)
+
+    failure_registry.update_registry(outcomes, failures_path)
 
     # Convert the list of data to a DataFrame and save it as CSV
     df = pd.DataFrame(data_list)
@@ -299,34 +532,78 @@ def fetch_financial_data_and_save(ticker_df, output_csv, max_workers=10):
     df.to_csv(output_csv, index=False, encoding='utf-8')
     print(f"Data saved to {output_csv}")
 
+def snapshot_version(input_csv):
+    # Changes whenever the snapshot file is rewritten
+    return os.stat(input_csv).st_mtime_ns
+
+# Boolean mask for a single column filter: (min, max) tuples, booleans, or substring matches
+def check_filter_value(column, value, dtype=None):
+    """
+    Raise ExpressionError unless value is a filter column_filter_mask can apply: None, a
+    [min, max] range of numbers or None, a boolean, or a string. With the column's dtype,
+    also check that ranges are on numeric columns and strings on text columns.
+    """
+    if value is None:
+        return
+    if isinstance(value, (list, tuple)):
+        if len(value) != 2 or not all(bound is None or (isinstance(bound, (int, float)) and not isinstance(bound, bool)) for bound in value):
+            raise screen_expressions.ExpressionError(f"Filter for {column} must be [min, max] with numbers or null.")
+        if dtype is not None and (pd.api.types.is_bool_dtype(dtype) or not pd.api.types.is_numeric_dtype(dtype)):
+            raise screen_expressions.ExpressionError(f"Range filter on non-numeric column: {column}")
+    elif isinstance(value, bool):
+        if dtype is not None and not (pd.api.types.is_bool_dtype(dtype) or dtype == object):
+            raise screen_expressions.ExpressionError(f"Boolean filter on non-boolean column: {column}")
+    elif isinstance(value, str):
+        if dtype is not None and pd.api.types.is_numeric_dtype(dtype):
+            raise screen_expressions.ExpressionError(f"Text filter on numeric column: {column}")
+    else:
+        raise screen_expressions.ExpressionError(f"Unsupported filter for {column}: {value!r}")
+
+def column_filter_mask(series, value):
+    check_filter_value(series.name, value, series.dtype)
+    mask = np.ones(len(series), dtype=bool)
+    if isinstance(value, tuple):  # For numeric filters with ranges
+        min_val, max_val = value
+        if min_val is not None:
+            mask &= (series >= min_val).to_numpy()
+        if max_val is not None:
+            mask &= (series <= max_val).to_numpy()
+    elif isinstance(value, bool):  # For boolean filters
+        mask &= (series == value).to_numpy()
+    elif isinstance(value, str):  # For categorical filters (string)
+        mask &= series.str.contains(value, case=False, na=False).to_numpy(dtype=bool)
+    return mask
+
 # Function to filter the saved data, format specific columns, and fill empty cells with "N/A"
-def filter_saved_data(input_csv, filters):
-    # Load the saved CSV file
-    df = pd.read_csv(input_csv, encoding='utf-8')
+def filter_saved_data(input_csv, filters, fill_na=True, derived_columns=None, expressions=None):
+    # Load the saved CSV file with compact dtypes (text fields are cleaned on load)
+    df = load_financial_metrics(input_csv)
+    version = (input_csv, snapshot_version(input_csv))
+
+    # Expressions only convert the columns they use, and share them with other requests on this snapshot
+    columns = screen_expressions.snapshot_columns(df, version).scope()
 
-    # Clean text fields in case there are any encoding issues
-    df['Sector'] = df['Sector'].apply(clean_text)
+    # Add computed columns first so the filters below can use them, e.g. {'Earnings Yield (%)': '100 / `PE Ratio`'}
+    if derived_columns:
+        df = screen_expressions.add_derived_columns(df, derived_columns, version, columns)
+
+    # Apply expression filters over whole columns, e.g. '`ROIC (%)` - `ROA (%)` > 5'
+    if expressions:
+        df = df[screen_expressions.evaluate_predicates(df, expressions, version, columns)]
 
     # Apply the filters passed as an argument
+    mask = np.ones(len(df), dtype=bool)
     for column, value in filters.items():
         if column in df.columns:
-            if isinstance(value, tuple):  # For numeric filters with ranges
-                min_val, max_val = value
-                if min_val is not None:
-                    df = df[df[column] >= min_val]
-                if max_val is not None:
-                    df = df[df[column] <= max_val]
-            elif isinstance(value, bool):  # For boolean filters
-                df = df[df[column] == value]
-            elif isinstance(value, str):  # For categorical filters (string)
-                df = df[df[column].str.contains(value, case=False, na=False)]
+            mask &= column_filter_mask(df[column], value)
+    df = df[mask]
 
-    df.replace([np.inf, -np.inf], np.nan, inplace=True)
+    # Keep the compact dtypes when the caller encodes the result itself
+    if not fill_na:
+        return df
 
     # Replace all NaN values with "N/A"
-    df = df.fillna("N/A")
-
-    return df
+    return pd.DataFrame(to_display_records(df), columns=df.columns)
 ########################################################################################################################
 
 # Define the filters to pass dynamically
@@ -0,0 +1,127 @@
+import json
+import os
+from datetime import date, datetime, timedelta, timezone
+
+# Persistent registry of tickers that fail in fetch_financial_data.
+#
+# Failures are classified as "throttled" (rate limiting, not the ticker's fault), "no_data"
+# (delisted or unknown symbols, missing statements) or "error" (timeouts and anything else).
+# Tickers with QUARANTINE_AFTER consecutive no_data failures, or ERROR_QUARANTINE_AFTER consecutive
+# errors (a ticker that times out every night), are skipped until a re-probe date that doubles with
+# every further failure. Throttling is counted separately and never quarantines. Failures count at
+# most once per day, so overlapping runs (e.g. one scheduler per gunicorn worker) count as one night.
+# A successful fetch removes the ticker from the registry.
+
+FAILURES_JSON = 'ticker_failures.json'
+QUARANTINE_AFTER = 2
+ERROR_QUARANTINE_AFTER = 5
+BASE_REPROBE_DAYS = 2
+MAX_REPROBE_DAYS = 64
+
+THROTTLED = 'throttled'
+NO_DATA = 'no_data'
+ERROR = 'error'
+
+THROTTLE_MARKERS = ['429', 'too many requests', 'rate limit', 'ratelimit']
+NO_DATA_MARKERS = ['404', 'not found', 'delisted', 'no data', 'no timezone', 'no price data']
+# A KeyError only means missing data when it names a price column or statement row the metrics need
+MISSING_STATEMENT_KEYS = ['high', 'total revenue', 'basic eps', 'net income', 'total assets',
+                          'operating cash flow', 'capital expenditure']
+
+def classify_failure(error):
+    """Return the failure class for an exception (or its message)."""
+    message = f"{type(error).__name__}: {error}".lower() if isinstance(error, Exception) else str(error).lower()
+    if any(marker in message for marker in THROTTLE_MARKERS):
+        return THROTTLED
+    if any(marker in message for marker in NO_DATA_MARKERS):
+        return NO_DATA
+    if message.startswith('keyerror') and any(f"'{key}'" in message for key in MISSING_STATEMENT_KEYS):
+        return NO_DATA
+    return ERROR
+
+def load_registry(path=FAILURES_JSON):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_registry(registry, path=FAILURES_JSON):
+    # Write to a temporary file first so readers never see a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(registry, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def record_failure(registry, ticker, failure_class, message, today=None):
+    today = today or date.today()
+    entry = registry.setdefault(ticker, {
+        'failures': 0,
+        'throttled': 0,
+        'errors': 0,
+        'first_failed': datetime.now(timezone.utc).isoformat(),
+        'next_probe': None,
+    })
+    entry['class'] = failure_class
+    entry['last_error'] = str(message)[:300]
+    entry['last_failed'] = datetime.now(timezone.utc).isoformat()
+
+    if failure_class == THROTTLED:
+        entry['throttled'] += 1
+        return entry
+
+    # Another run on the same day already counted this ticker's failure
+    if entry.get('last_counted') == today.isoformat():
+        return entry
+    entry['last_counted'] = today.isoformat()
+
+    # Exponential re-probe interval once the ticker has failed enough days in a row
+    counter, threshold = ('errors', ERROR_QUARANTINE_AFTER) if failure_class == ERROR else ('failures', QUARANTINE_AFTER)
+    entry[counter] = entry.get(counter, 0) + 1
+    if entry[counter] >= threshold:
+        days = min(BASE_REPROBE_DAYS * 2 ** (entry[counter] - threshold), MAX_REPROBE_DAYS)
+        entry['next_probe'] = (today + timedelta(days=days)).isoformat()
+    return entry
+
+def record_success(registry, ticker):
+    registry.pop(ticker, None)
+
+def update_registry(outcomes, path=FAILURES_JSON):
+    """
+    Apply one fetch run's outcomes ({ticker: (failure class, message), or None for a success})
+    to the registry on disk. It is re-loaded right before saving, so tickers released through
+    the API while the run was in progress stay released.
+    """
+    registry = load_registry(path)
+    for ticker, error in outcomes.items():
+        if error is None:
+            record_success(registry, ticker)
+        else:
+            record_failure(registry, ticker, *error)
+    save_registry(registry, path)
+    return registry
+
+def is_quarantined(registry, ticker, today=None):
+    entry = registry.get(ticker)
+    if not entry or not entry.get('next_probe'):
+        return False
+    today = today or date.today()
+    return today < date.fromisoformat(entry['next_probe'])
+
+def summarize(registry, today=None):
+    """Counts per failure class plus the quarantined tickers and their re-probe dates."""
+    today = today or date.today()
+    counts = {THROTTLED: 0, NO_DATA: 0, ERROR: 0}
+    for entry in registry.values():
+        counts[entry.get('class', ERROR)] = counts.get(entry.get('class', ERROR), 0) + 1
+
+    quarantined = {
+        ticker: entry['next_probe']
+        for ticker, entry in registry.items()
+        if is_quarantined(registry, ticker, today)
+    }
+    return {
+        'tracked': len(registry),
+        'by_class': counts,
+        'quarantined_count': len(quarantined),
+        'quarantined': quarantined,
+    }
@@ -0,0 +1,210 @@
+import json
+import os
+from datetime import datetime, timezone
+import numpy as np
+import Stock_Screener
+import screen_expressions
+
+# Named screens are stored in the same JSON shape the frontend sends to /filter_data.
+# After each daily refresh every screen is evaluated in one pass over the snapshot, and the
+# members of each screen are saved together with the tickers that entered or exited it.
+
+SCREENS_JSON = 'saved_screens.json'
+SCREEN_RESULTS_JSON = 'screen_results.json'
+# Names taken by the /screens/results and /screens/run routes
+RESERVED_SCREEN_NAMES = ['results', 'run']
+
+def parse_screen(body, dtypes=None):
+    """
+    Split a /filter_data style request into column filters, computed columns and expression filters.
+    List values become (min, max) tuples; raises ExpressionError for malformed bodies, and for
+    filters that don't fit their column's type when the snapshot's dtypes are given.
+    """
+    if not isinstance(body, dict):
+        raise screen_expressions.ExpressionError('Filters must be a JSON object.')
+    body = dict(body)
+
+    # Computed columns ({name: expression}) and expression filters ([expression, ...]) are optional
+    derived_columns = body.pop('derived_columns', None) or {}
+    expressions = body.pop('expressions', None) or []
+    if not isinstance(derived_columns, dict) or not isinstance(expressions, list):
+        raise screen_expressions.ExpressionError('derived_columns must be an object and expressions a list.')
+    if not all(isinstance(text, str) for text in list(derived_columns.values()) + expressions):
+        raise screen_expressions.ExpressionError('Expressions must be strings.')
+
+    # Computed columns are always numeric
+    dtypes = dict(dtypes) if dtypes is not None else {}
+    dtypes.update({name: np.float64 for name in derived_columns if isinstance(name, str)})
+
+    # Check each filter's shape (and type, if dtypes are given), then convert lists to tuples
+    filters = {}
+    for key, value in body.items():
+        Stock_Screener.check_filter_value(key, value, dtypes.get(key))
+        if isinstance(value, list):
+            filters[key] = tuple(value)  # Convert list to tuple
+        else:
+            filters[key] = value  # Keep as is for non-list items like booleans or strings
+
+    return {'filters': filters, 'derived_columns': derived_columns, 'expressions': expressions}
+
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_json(path, data, indent=None):
+    # Write to a temporary file first so readers never see a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=indent)
+    os.replace(tmp_path, path)
+
+def load_screens(path=SCREENS_JSON):
+    return _read_json(path, {})
+
+def save_screen(name, body, path=SCREENS_JSON, df=None):
+    # Reject reserved names, malformed screens, and screens that don't evaluate on the given snapshot, before storing them
+    if name in RESERVED_SCREEN_NAMES:
+        raise screen_expressions.ExpressionError(f"{name} is a reserved screen name.")
+    parse_screen(body)
+    if df is not None:
+        _, errors = evaluate_screens(df, {name: body})
+        if errors:
+            raise screen_expressions.ExpressionError(errors[name])
+
+    screens = load_screens(path)
+    screens[name] = body
+    _write_json(path, screens, indent=2)
+
+def delete_screen(name, path=SCREENS_JSON):
+    screens = load_screens(path)
+    if name not in screens:
+        return False
+    del screens[name]
+    _write_json(path, screens, indent=2)
+    return True
+
+def load_screen_results(path=SCREEN_RESULTS_JSON):
+    return _read_json(path, {})
+
+def _freeze(value):
+    # Hashable key for a filter value, so (0, 15) and [0, 15] share a mask
+    return json.dumps(value, sort_keys=True)
+
+def evaluate_screens(df, screens, version=None):
+    """
+    Evaluate many screens over one snapshot, returning {name: set of tickers} and {name: error}.
+
+    Each column filter and expression is computed once as a mask over the whole snapshot and
+    shared by every screen that uses it, so dozens of overlapping screens cost little more than one.
+    """
+    masks = {}
+    # Column arrays are converted once per snapshot and shared by every frame and expression
+    base_columns = screen_expressions.snapshot_columns(df, version)
+    frames = {(): (df, base_columns)}
+    members = {}
+    errors = {}
+
+    for name, body in screens.items():
+        try:
+            screen = parse_screen(body, df.dtypes)
+
+            # Screens with the same computed columns share one frame, its column arrays and the masks over it
+            derived_columns = screen['derived_columns']
+            scope = tuple(derived_columns.items())
+            if scope not in frames:
+                columns = base_columns.scope()
+                frames[scope] = (screen_expressions.add_derived_columns(df, derived_columns, version, columns), columns)
+            frame, columns = frames[scope]
+
+            mask = np.ones(len(frame), dtype=bool)
+            for column, value in screen['filters'].items():
+                if column not in frame.columns:
+                    continue
+                key = (scope if column in derived_columns else (), 'column', column, _freeze(value))
+                if key not in masks:
+                    masks[key] = Stock_Screener.column_filter_mask(frame[column], value)
+                mask &= masks[key]
+
+            for text in screen['expressions']:
+                key = (scope, 'expression', text)
+                if key not in masks:
+                    masks[key] = screen_expressions.evaluate_predicates(frame, [text], version, columns)
+                mask &= masks[key]
+
+            members[name] = set(frame['Ticker'].to_numpy()[mask])
+        except screen_expressions.ExpressionError as e:
+            errors[name] = str(e)
+
+    return members, errors
+
+def run_saved_screens(input_csv='financial_metrics.csv', screens_path=SCREENS_JSON, results_path=SCREEN_RESULTS_JSON):
+    """
+    Evaluate all saved screens against the current snapshot and store their members plus the
+    tickers that entered or exited each screen since the previous snapshot.
+
+    Members are stored as indices into the sorted 'tickers' list of the snapshot; entered/exited
+    are ticker symbols, since exited tickers may no longer be in the snapshot. The previous
+    snapshot's members are kept as the 'baseline', so re-running on the same snapshot (e.g. via
+    /screens/run) repeats the same diffs instead of reporting nothing changed.
+    """
+    screens = load_screens(screens_path)
+    df = Stock_Screener.load_financial_metrics(input_csv)
+    version = (input_csv, Stock_Screener.snapshot_version(input_csv))
+    members, errors = evaluate_screens(df, screens, version)
+
+    # Diff against the previous snapshot: the last run's members, or its baseline if it ran on this same snapshot
+    previous = load_screen_results(results_path)
+    if previous.get('snapshot_version') == version[1]:
+        baseline = previous.get('baseline', {})
+    else:
+        baseline = {
+            'snapshot_version': previous.get('snapshot_version'),
+            'tickers': previous.get('tickers', []),
+            'members': {name: result.get('members', []) for name, result in previous.get('screens', {}).items()},
+        }
+    baseline_tickers = baseline.get('tickers', [])
+    previous_members = {
+        name: {baseline_tickers[i] for i in indices}
+        for name, indices in baseline.get('members', {}).items()
+    }
+
+    tickers = sorted(df['Ticker'].dropna().unique().tolist())
+    ticker_index = {ticker: i for i, ticker in enumerate(tickers)}
+
+    results = {}
+    for name, current in members.items():
+        before = previous_members.get(name)
+        results[name] = {
+            'count': len(current),
+            'members': sorted(ticker_index[ticker] for ticker in current),
+            # A screen missing from the previous snapshot has nothing to diff against
+            'entered': sorted(current - before) if before is not None else [],
+            'exited': sorted(before - current) if before is not None else [],
+        }
+
+    output = {
+        'evaluated_at': datetime.now(timezone.utc).isoformat(),
+        'snapshot_version': version[1],
+        'tickers': tickers,
+        'screens': results,
+        'errors': errors,
+        'baseline': baseline,
+    }
+    _write_json(results_path, output)
+    return output
+
+def decode_screen_results(results):
+    """Expand stored member indices back to ticker symbols for API consumers."""
+    tickers = results.get('tickers', [])
+    return {
+        'evaluated_at': results.get('evaluated_at'),
+        'snapshot_version': results.get('snapshot_version'),
+        'baseline_snapshot_version': results.get('baseline', {}).get('snapshot_version'),
+        'screens': {
+            name: dict(result, members=[tickers[i] for i in result['members']])
+            for name, result in results.get('screens', {}).items()
+        },
+        'errors': results.get('errors', {}),
+    }
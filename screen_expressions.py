@@ -0,0 +1,283 @@
+import ast
+import functools
+import re
+import numpy as np
+import pandas as pd
+
+# Safe expression language for computed columns and filters over the metrics snapshot.
+#
+# Column names go in backticks when they are not plain identifiers, e.g.
+#     `FCF Yield (%)` > 2 * `Dividend Yield (%)`
+#     `ROIC (%)` - `ROA (%)` > 5 and Sector == 'Technology'
+#     100 / `PE Ratio`                        (a computed "Earnings Yield (%)" column)
+#
+# Expressions are parsed once, checked against the snapshot's columns, and compiled into a tree of
+# numpy functions that evaluate whole columns at a time (never eval() and never row by row).
+
+class ExpressionError(ValueError):
+    pass
+
+BINARY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power,
+    ast.Mod: np.mod,
+}
+
+COMPARISON_OPERATORS = {
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+}
+
+FUNCTIONS = {
+    'abs': (np.abs, 1),
+    'sqrt': (np.sqrt, 1),
+    'log': (np.log, 1),
+    'min': (np.fmin, 2),
+    'max': (np.fmax, 2),
+}
+
+MAX_EXPRESSION_LENGTH = 500
+MAX_CACHED_EXPRESSIONS = 256
+
+# Compiled expressions, cleared whenever the snapshot version changes
+_compiled_cache = {'version': None, 'expressions': {}}
+# Converted column arrays of the current snapshot, shared by every request on the same version
+_column_cache = {'version': None, 'columns': None}
+
+def _replace_quoted_columns(text):
+    # Swap `quoted column names` for placeholder identifiers so the text parses as Python
+    names = {}
+
+    def placeholder(match):
+        name = f"__column_{len(names)}"
+        names[name] = match.group(1)
+        return name
+
+    return re.sub(r'`([^`]+)`', placeholder, text), names
+
+def _compile_node(node, names, schema):
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body, names, schema)
+
+    if isinstance(node, ast.Name):
+        column = names.get(node.id, node.id)
+        if column not in schema:
+            raise ExpressionError(f"Unknown column: {column}")
+        return lambda columns: columns[column]
+
+    if isinstance(node, ast.Constant):
+        if not isinstance(node.value, (int, float, str)):
+            raise ExpressionError(f"Unsupported constant: {node.value!r}")
+        # Numbers are floats so integer overflow and int ** -1 can't happen inside numpy
+        value = node.value
+        if isinstance(value, int) and not isinstance(value, bool):
+            try:
+                value = float(value)
+            except OverflowError:
+                raise ExpressionError(f"Constant too large: {node.value}")
+        return lambda columns: value
+
+    if isinstance(node, ast.UnaryOp):
+        operand = _compile_node(node.operand, names, schema)
+        if isinstance(node.op, ast.USub):
+            return lambda columns: np.negative(operand(columns))
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        if isinstance(node.op, ast.Not):
+            if not _is_predicate(node.operand):
+                return lambda columns: np.logical_not(operand(columns))
+            # Negating a comparison must not make rows with missing values match: not `PE Ratio` > 5
+            # keeps the rows where the PE ratio is known and at most 5, like `PE Ratio` <= 5
+            known = _compile_known(node.operand, names, schema)
+            return lambda columns: np.logical_and(np.logical_not(operand(columns)), known(columns))
+
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        function = BINARY_OPERATORS[type(node.op)]
+        left = _compile_node(node.left, names, schema)
+        right = _compile_node(node.right, names, schema)
+        return lambda columns: function(left(columns), right(columns))
+
+    if isinstance(node, ast.BoolOp):
+        function = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        values = [_compile_node(value, names, schema) for value in node.values]
+
+        def evaluate_bool(columns):
+            result = values[0](columns)
+            for value in values[1:]:
+                result = function(result, value(columns))
+            return result
+        return evaluate_bool
+
+    if isinstance(node, ast.Compare):
+        if not all(type(op) in COMPARISON_OPERATORS for op in node.ops):
+            raise ExpressionError("Unsupported comparison operator")
+        operands = [_compile_node(operand, names, schema) for operand in [node.left] + node.comparators]
+        functions = [COMPARISON_OPERATORS[type(op)] for op in node.ops]
+
+        # Chained comparisons (0 < `PE Ratio` < 15) are and-ed together like in Python,
+        # and a comparison involving a missing value is always false
+        def evaluate_compare(columns):
+            result = None
+            for function, left, right in zip(functions, operands, operands[1:]):
+                left_values, right_values = left(columns), right(columns)
+                step = np.asarray(function(left_values, right_values), dtype=bool)
+                step = step & pd.notna(left_values) & pd.notna(right_values)
+                result = step if result is None else np.logical_and(result, step)
+            return result
+        return evaluate_compare
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+        function, arity = FUNCTIONS[node.func.id]
+        if len(node.args) != arity:
+            raise ExpressionError(f"{node.func.id}() takes {arity} argument(s)")
+        args = [_compile_node(arg, names, schema) for arg in node.args]
+        return lambda columns: function(*[arg(columns) for arg in args])
+
+    raise ExpressionError(f"Unsupported syntax: {type(node).__name__}")
+
+def _compile_known(node, names, schema):
+    # Rows where every value a predicate compares is present
+    if isinstance(node, ast.Compare):
+        operands = [_compile_node(operand, names, schema) for operand in [node.left] + node.comparators]
+        return lambda columns: functools.reduce(np.logical_and, [pd.notna(operand(columns)) for operand in operands])
+    if isinstance(node, ast.BoolOp):
+        parts = [_compile_known(value, names, schema) for value in node.values]
+        return lambda columns: functools.reduce(np.logical_and, [part(columns) for part in parts])
+    if isinstance(node, ast.UnaryOp):
+        return _compile_known(node.operand, names, schema)
+    return lambda columns: True
+
+def _is_predicate(node):
+    # A filter must be a comparison, a boolean constant, or and/or/not over those
+    if isinstance(node, ast.Compare):
+        return True
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, bool)
+    if isinstance(node, ast.BoolOp):
+        return all(_is_predicate(value) for value in node.values)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return _is_predicate(node.operand)
+    return False
+
+def compile_expression(text, schema, predicate=False):
+    """
+    Parse and validate an expression against the given column names, returning a function of a column dict.
+    With predicate=True the expression must be a comparison (or and/or/not of comparisons).
+    """
+    if not isinstance(text, str) or not text.strip():
+        raise ExpressionError("Expression must be a non-empty string")
+    if len(text) > MAX_EXPRESSION_LENGTH:
+        raise ExpressionError(f"Expression longer than {MAX_EXPRESSION_LENGTH} characters")
+
+    source, names = _replace_quoted_columns(text.strip())
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError as e:
+        raise ExpressionError(f"Invalid expression {text!r}: {e.msg}")
+    if predicate and not _is_predicate(tree.body):
+        raise ExpressionError(f"Filter expression must be a comparison: {text}")
+    return _compile_node(tree, names, set(schema))
+
+def get_compiled_expression(text, schema, version, predicate=False):
+    """Compile an expression once per snapshot version and schema."""
+    if _compiled_cache['version'] != version:
+        _compiled_cache['version'] = version
+        _compiled_cache['expressions'] = {}
+
+    key = (text, tuple(schema), predicate)
+    if key not in _compiled_cache['expressions']:
+        if len(_compiled_cache['expressions']) >= MAX_CACHED_EXPRESSIONS:
+            _compiled_cache['expressions'] = {}
+        _compiled_cache['expressions'][key] = compile_expression(text, schema, predicate)
+    return _compiled_cache['expressions'][key]
+
+def _column_array(series):
+    # Numeric columns as float64, everything else (Sector, Industry, Ticker) as plain object arrays.
+    # float32 columns go through their shortest repr, so 3.34 stays 3.34 and matches the literal 3.34
+    if series.dtype == np.float32:
+        return series.to_numpy().astype(str).astype(np.float64)
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+    return series.astype(object).to_numpy()
+
+class ColumnArrays(dict):
+    """
+    Column arrays for evaluating expressions over a DataFrame, each converted on first use,
+    so an expression only pays for the columns it references.
+    """
+    def __init__(self, df, base=None):
+        super().__init__()
+        self.df = df
+        self.base = base
+
+    def __missing__(self, col):
+        values = self.base[col] if self.base is not None else _column_array(self.df[col])
+        self[col] = values
+        return values
+
+    def scope(self):
+        """Arrays for a frame with its own computed columns, reading the other columns through these."""
+        return ColumnArrays(self.df, self)
+
+def snapshot_columns(df, version=None):
+    """Column arrays of the snapshot DataFrame, cached per snapshot version (uncached without one)."""
+    if version is None:
+        return ColumnArrays(df)
+    if _column_cache['version'] != version:
+        _column_cache['version'] = version
+        _column_cache['columns'] = ColumnArrays(df)
+    return _column_cache['columns']
+
+def _evaluate(compiled, columns, text, length):
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        try:
+            result = compiled(columns)
+        except TypeError:
+            raise ExpressionError(f"Incompatible column types in expression: {text}")
+        except (ValueError, OverflowError) as e:
+            raise ExpressionError(f"Cannot evaluate expression {text}: {e}")
+    return np.broadcast_to(np.asarray(result), (length,))
+
+def add_derived_columns(df, derived_columns, version=None, columns=None):
+    """
+    Add computed columns ({name: expression}) to the DataFrame, in order, so later
+    expressions can refer to earlier ones. Division by zero gives NaN rather than inf.
+    The computed arrays are also stored in columns (the frame's ColumnArrays scope), if given.
+    """
+    df = df.copy()
+    columns = columns if columns is not None else ColumnArrays(df)
+    schema = list(df.columns)
+    for name, text in derived_columns.items():
+        if not isinstance(name, str) or not name.strip() or name in schema:
+            raise ExpressionError(f"Invalid or duplicate computed column name: {name!r}")
+        compiled = get_compiled_expression(text, schema, version)
+        result = _evaluate(compiled, columns, text, len(df))
+        try:
+            values = result.astype(np.float64)
+        except (TypeError, ValueError):
+            raise ExpressionError(f"Computed column {name} is not numeric: {text}")
+        values = np.where(np.isinf(values), np.nan, values)
+        columns[name] = values
+        schema.append(name)
+        df[name] = values
+    return df
+
+def evaluate_predicates(df, expressions, version=None, columns=None):
+    """
+    Return a boolean mask of rows matching every predicate expression (comparisons with missing
+    values are false, also under not). columns are the frame's ColumnArrays, if already built.
+    """
+    columns = columns if columns is not None else ColumnArrays(df)
+    schema = list(df.columns)
+    mask = np.ones(len(df), dtype=bool)
+    for text in expressions:
+        compiled = get_compiled_expression(text, schema, version, predicate=True)
+        mask &= _evaluate(compiled, columns, text, len(df)).astype(bool)
+    return mask
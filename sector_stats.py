@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+# Robust per-sector and per-industry statistics for every metric column.
+#
+# Each (level, metric) pair is computed from a single sort of the values by (group, value):
+# group boundaries come from bincount, quantiles from index interpolation into the sorted array,
+# the IQR-trimmed mean from masked bincounts, and percentile ranks from runs of equal values.
+# Nothing loops over groups or rows, so the table is cheap enough to rebuild for every snapshot.
+
+SECTOR_STATS_CSV = 'sector_stats.csv'
+STATS_LEVELS = ['Sector', 'Industry']
+STATS_QUANTILES = {'p10': 0.10, 'p25': 0.25, 'median': 0.50, 'p75': 0.75, 'p90': 0.90}
+STATS_COLUMNS = ['count', 'trimmed_mean'] + list(STATS_QUANTILES)
+
+# Industries with fewer valid values than this fall back to their sector's statistics
+MIN_GROUP_SIZE = 5
+
+HIGHLIGHT_MODES = ['ratio', 'percentile']
+# Percentile mode: at or above the 75th percentile rank is "above", at or below the 25th is "below"
+PERCENTILE_BANDS = (25, 75)
+
+def group_metric_stats(codes, values, n_groups):
+    """
+    Statistics for one metric across all groups from a single sort.
+
+    codes are group codes per row (-1 for no group) and values the metric per row (NaN for missing).
+    Returns ({stat: array per group}, percentile rank per row in its group, NaN where missing).
+    """
+    valid = np.flatnonzero((codes >= 0) & ~np.isnan(values))
+    order = valid[np.lexsort((values[valid], codes[valid]))]
+    sorted_codes = codes[order]
+    sorted_values = values[order]
+
+    counts = np.bincount(sorted_codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    stats = {'count': counts}
+    percentiles = np.full(len(values), np.nan)
+
+    if len(sorted_values) == 0:
+        for name in STATS_COLUMNS[1:]:
+            stats[name] = np.full(n_groups, np.nan)
+        return stats, percentiles
+
+    # Linear-interpolated quantiles (same as pandas' default) at positions start + q * (n - 1)
+    empty = counts == 0
+    last_index = len(sorted_values) - 1
+    for name, q in STATS_QUANTILES.items():
+        position = starts + q * np.maximum(counts - 1, 0)
+        lower = np.minimum(np.floor(position).astype(np.int64), last_index)
+        upper = np.minimum(np.ceil(position).astype(np.int64), last_index)
+        quantile = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+        stats[name] = np.where(empty, np.nan, quantile)
+
+    # Mean of the values inside [q1 - 1.5 * IQR, q3 + 1.5 * IQR] of each group
+    iqr = stats['p75'] - stats['p25']
+    lower_bound = (stats['p25'] - 1.5 * iqr)[sorted_codes]
+    upper_bound = (stats['p75'] + 1.5 * iqr)[sorted_codes]
+    inside = (sorted_values >= lower_bound) & (sorted_values <= upper_bound)
+    inside_counts = np.bincount(sorted_codes, weights=inside, minlength=n_groups)
+    inside_sums = np.bincount(sorted_codes, weights=np.where(inside, sorted_values, 0), minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats['trimmed_mean'] = np.where(inside_counts > 0, inside_sums / inside_counts, np.nan)
+
+    # Mid-rank percentile: (values below + half of the equal values) / group size, so ties share a rank
+    new_run = np.concatenate([[True], (sorted_codes[1:] != sorted_codes[:-1]) | (sorted_values[1:] != sorted_values[:-1])])
+    run_starts = np.flatnonzero(new_run)
+    run_ids = np.cumsum(new_run) - 1
+    run_lengths = np.diff(np.append(run_starts, len(sorted_values)))
+    below = run_starts[run_ids] - starts[sorted_codes]
+    percentiles[order] = (below + 0.5 * run_lengths[run_ids]) / counts[sorted_codes] * 100
+
+    return stats, percentiles
+
+def compute_group_stats(df, columns, levels=STATS_LEVELS):
+    """
+    Compute statistics for every metric per sector and per industry.
+
+    Returns the lookup table (one row per level, group and metric) and the per-row statistics
+    {level: {metric: {stat: array}}} used for highlighting, including each row's 'percentile'.
+    """
+    tables = []
+    row_stats = {}
+    for level in levels:
+        groups = df[level].astype('category')
+        codes = groups.cat.codes.to_numpy().astype(np.int64)
+        names = groups.cat.categories
+        row_stats[level] = {}
+
+        for col in columns:
+            # float32 metrics go through their shortest repr, so 7.55 stays 7.55 and doesn't cross an IQR fence
+            values = df[col].to_numpy()
+            if values.dtype == np.float32:
+                values = values.astype(str).astype(np.float64)
+            else:
+                values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            stats, percentiles = group_metric_stats(codes, values, len(names))
+
+            # Broadcast the group statistics back to rows (NaN for rows without a group)
+            row_stats[level][col] = {
+                name: np.where(codes >= 0, np.asarray(stat, dtype=np.float64)[codes], np.nan)
+                for name, stat in stats.items()
+            }
+            row_stats[level][col]['percentile'] = percentiles
+
+            table = pd.DataFrame(stats)[STATS_COLUMNS]
+            table.insert(0, 'Metric', col)
+            table.insert(0, 'Group', names)
+            table.insert(0, 'Level', level)
+            tables.append(table[table['count'] > 0])
+
+    stats_df = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=['Level', 'Group', 'Metric'] + STATS_COLUMNS)
+    return compact_stats(stats_df), row_stats
+
+def compact_stats(stats_df):
+    """Categorical keys, int32 counts and float32 statistics."""
+    stats_df = stats_df.copy()
+    for col in ['Level', 'Group', 'Metric']:
+        stats_df[col] = stats_df[col].astype('category')
+    stats_df['count'] = stats_df['count'].astype(np.int32)
+    for col in STATS_COLUMNS[1:]:
+        stats_df[col] = stats_df[col].astype(np.float32)
+    return stats_df
+
+def save_stats(stats_df, output_csv=SECTOR_STATS_CSV):
+    stats_df.to_csv(output_csv, index=False)
+
+def load_stats(input_csv=SECTOR_STATS_CSV):
+    return compact_stats(pd.read_csv(input_csv, encoding='utf-8'))
+
+def row_benchmark(row_stats, col, level='Sector'):
+    """
+    Per-row statistics to compare a metric against: the sector's, or the industry's where the
+    industry has at least MIN_GROUP_SIZE values for the metric (otherwise the sector's).
+    """
+    sector = row_stats['Sector'][col]
+    if level == 'Sector':
+        return sector
+
+    industry = row_stats['Industry'][col]
+    use_industry = industry['count'] >= MIN_GROUP_SIZE
+    return {name: np.where(use_industry, industry[name], sector[name]) for name in sector}
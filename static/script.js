@@ -4,7 +4,8 @@ document.addEventListener('DOMContentLoaded', function() {
         pagination: "local",  // Enable client-side pagination
         paginationSize: 20,  // Number of rows per page
         paginationSizeSelector: [20, 50, 75, 100],  // Dropdown to select rows per page+
-        ajaxURL: "/get_initial_data",  // URL to fetch the initial data
+        ajaxURL: "/get_initial_data?format=columnar",  // URL to fetch the initial data (compact columnar payload)
+        ajaxResponse: (url, params, response) => decodeColumnar(response),  // Expand column arrays into table rows
         initialSort: [{ column: "Market Cap", dir: "desc" }],  // Sort by Market Cap in descending order by default
         columns: [
             { title: "Ticker", field: "Ticker", frozen: true },
@@ -110,6 +111,30 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .catch(error => console.error('Error fetching industries:', error));
 
+    // Expand a columnar payload ({columns, length, data, dictionaries, highlight_labels}) into row objects
+    function decodeColumnar(payload) {
+        const rows = new Array(payload.length);
+        for (let i = 0; i < payload.length; i++) {
+            rows[i] = {};
+        }
+
+        payload.columns.forEach(column => {
+            const values = payload.data[column];
+            const dictionary = payload.dictionaries[column];
+
+            for (let i = 0; i < payload.length; i++) {
+                let value = values[i];
+                if (dictionary) {
+                    value = value >= 0 ? dictionary[value] : null;  // Categorical code, -1 means missing
+                } else if (column.endsWith("_highlight")) {
+                    value = payload.highlight_labels[value];  // int8 code to "above"/"within"/"below"
+                }
+                rows[i][column] = value === null || value === undefined ? "N/A" : value;
+            }
+        });
+        return rows;
+    }
+
     function highlightTextFormatter(cell, fieldName, baseFormatter) {
         const highlightStatus = cell.getRow().getData()[`${fieldName}_highlight`];
         const value = baseFormatter(cell);
@@ -208,12 +233,14 @@ document.addEventListener('DOMContentLoaded', function() {
             'EV/EBITDA': getMinMax('evEbitdaMin', 'evEbitdaMax'),
             'Recent 52-Week High': mapRecent52WeekHigh(document.getElementById('recent52WeekHigh').value),
             'Sector': document.getElementById('sector').value !== "Any" ? document.getElementById('sector').value : null,
-            'Industry': document.getElementById('industry').value !== "Any" ? document.getElementById('industry').value : null
+            'Industry': document.getElementById('industry').value !== "Any" ? document.getElementById('industry').value : null,
+            'derived_columns': parseDerivedColumns(document.getElementById('derivedColumns').value),
+            'expressions': parseLines(document.getElementById('expressionFilters').value)
         };
 
         console.log("Filters to be sent to backend:", filters);
 
-        fetch('/filter_data', {
+        fetch('/filter_data?format=columnar', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -223,7 +250,12 @@ document.addEventListener('DOMContentLoaded', function() {
         .then(response => response.json())
         .then(data => {
             console.log("Filtered data received from server:", data);
-            table.setData(data);  // Update the table with the filtered data
+            if (data.status === "error") {
+                alert(data.message);  // Invalid expression or computed column
+                return;
+            }
+            syncComputedColumns(data.columns);
+            table.setData(decodeColumnar(data));  // Update the table with the filtered data
         })
         .catch(error => console.error('Error:', error));
     });
@@ -237,17 +269,21 @@ document.addEventListener('DOMContentLoaded', function() {
         const currentPageSize = table.getPageSize();
 
         // Reset all input fields (number and text)
-        document.querySelectorAll('input[type="number"], input[type="text"]').forEach(input => {
-            input.value = '';  // Clear the value of the number and text inputs
+        document.querySelectorAll('input[type="number"], input[type="text"], textarea').forEach(input => {
+            input.value = '';  // Clear the value of the number and text inputs and expression boxes
         });
 
+        // Drop any computed columns added by previous filters
+        computedColumns.forEach(field => table.deleteColumn(field));
+        computedColumns = [];
+
         // Reset all dropdowns to their default value (for example, "Any")
         document.querySelectorAll('select').forEach(select => {
             select.value = 'Any';  // Set all selects to the default "Any" value
         });
 
         // Reload the table with unfiltered data
-        table.setData("/get_initial_data").then(function() {
+        table.setData("/get_initial_data?format=columnar").then(function() {
             // Restore the previously selected page size after the table reloads
             table.setPageSize(currentPageSize);
         });
@@ -264,6 +300,38 @@ document.addEventListener('DOMContentLoaded', function() {
         return [minValue, maxValue];
     }
 
+    // Split a textarea into its non-empty lines
+    function parseLines(text) {
+        return text.split("\n").map(line => line.trim()).filter(line => line.length > 0);
+    }
+
+    // Parse "Name = expression" lines into {name: expression}; "==" inside the expression is left alone
+    function parseDerivedColumns(text) {
+        const derivedColumns = {};
+        parseLines(text).forEach(line => {
+            const match = line.match(/^([^=]+?)\s*=(?!=)\s*(.+)$/);
+            if (match) {
+                derivedColumns[match[1].trim()] = match[2];
+            }
+        });
+        return derivedColumns;
+    }
+
+    // Show computed columns returned by the server and drop the ones it no longer sends
+    let computedColumns = [];
+    function syncComputedColumns(columns) {
+        computedColumns.filter(field => !columns.includes(field)).forEach(field => table.deleteColumn(field));
+        computedColumns = computedColumns.filter(field => columns.includes(field));
+
+        const existing = new Set(table.getColumns().map(column => column.getField()));
+        columns.forEach(field => {
+            if (!existing.has(field) && !field.endsWith("_highlight")) {
+                table.addColumn({ title: field, field: field, sorter: "number", formatter: moneyFormatter });
+                computedColumns.push(field);
+            }
+        });
+    }
+
     // Function to map the "Recent 52-Week High" dropdown
     function mapRecent52WeekHigh(value) {
         if (value === "Yes") {